@@ -5,57 +5,229 @@
 A simple API for spinning up VM instances on my hosts.
 """
 
-from typing import Any, Optional, List, Dict
-from flask import Flask, request, jsonify, abort, Response
-from ast import literal_eval
-from ipaddress import ip_address
+from typing import Any, Optional, List, Dict, Callable, AsyncIterator, Tuple
+from quart import Quart, request, abort, Response
 from http import HTTPStatus
 from cachetools import cached, TTLCache
-from asyncio import run
-
-from libvirtConnector import LVConn
+from asyncio import (gather, wait, get_running_loop, ensure_future, as_completed, Lock as AsyncLock,
+                     Semaphore)
+from hashlib import sha1
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from redis import Redis
+from rq import Queue
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
+from fastjsonschema import JsonSchemaException
+from cache import AsyncTTL
+from libvirt import libvirtError
+from werkzeug.http import parse_etags
+
+import aiofiles
+import orjson
+
+from libvirtConnector import LVConnPool, startEventLoop
+from schemas import validateList, validateXML, validateResources, validateCreate
 from settings import env
-from utils import asyncCachedTimedFileIO
 
 
-app = Flask(__name__)
+app = Quart(__name__)
+
+# Libvirt calls block on SSH, so give them their own threads rather than
+# competing for the loop's default executor. There may be several in flight per
+# host (e.g. /api/xml fetches several guests' XML at once), so this isn't sized
+# to the number of hosts.
+_EXECUTOR = ThreadPoolExecutor(max_workers=env['LIBVIRT_THREADS'])
+
+# Templates one /api/xml request may fetch at once, so that a long list of
+# guests can't take every libvirt thread from the other endpoints.
+_XML_FETCHES = 4
+
+# Libvirt connections stay open between requests, one per host.
+POOL = LVConnPool()
+
+# Seconds to wait on connections at startup, well inside gunicorn's worker
+# timeout. Hosts that take longer keep connecting in the background.
+_WARM_POOL_TIMEOUT = 10
+
+# VM creation can take minutes, so it's handed off to an RQ worker.
+_REDIS = Redis.from_url(env['REDIS_URL'])
+_QUEUE = Queue(connection=_REDIS, default_timeout=env['CREATE_JOB_TIMEOUT'])
+
+# The uptime cache is also shared between workers through Redis.
+_UPTIME_KEY = 'uptime:v1'
+_uptimeLock: Optional[AsyncLock] = None
+
+# The index page doesn't change while the API is up, so read and hash it once.
+with open('static_html_pages/index.html', 'rb') as fh:
+    _INDEX = fh.read()
+_INDEX_ETAG = sha1(_INDEX).hexdigest()
 
 
 class InvalidUsage(Exception):
     """
     Raised manually to give more context around API failures.
     """
-    status_code = HTTPStatus.BAD_REQUEST
-
-    def __init__(self, message: str, status_code: Optional[int] =None,
+    def __init__(self, message: str, status_code: int =HTTPStatus.BAD_REQUEST,
                  payload: Optional[dict] =None) -> None:
         Exception.__init__(self)
         self.message = message
-        if status_code is not None:
-            self.status_code = status_code
-        self.payload = payload
+        self.status_code = status_code
+        self.payload = payload or {}
 
     def to_dict(self) -> dict:
-        rv = dict(self.payload or ())
-        rv['message'] = self.message
-        return rv
+        return {**self.payload, 'message': self.message}
+
+
+async def getJSON() -> Any:
+    """
+    Parse the request's JSON body with orjson rather than the standard library
+    (which `request.get_json` uses).
+
+    Returns:
+        The parsed body, or `None` if the request has no body.
+
+    Raises:
+        InvalidUsage: If the body isn't valid JSON.
+    """
+    body = await request.get_data(raw=True)
+    if not body:
+        return None
+
+    try:
+        return orjson.loads(body)
+    except ValueError as err:
+        raise InvalidUsage(f'Invalid JSON body: {err}')
+
+
+def validate(validator: Callable, data: Any) -> Dict[str, Any]:
+    """
+    Validate a request's JSON body against one of the compiled schemas.
 
+    Args:
+        validator: A validator from `schemas`.
+        data: The request's JSON body.
 
-def checkValidHosts(*hosts: str) -> bool:
+    Returns:
+        The validated body.
+
+    Raises:
+        InvalidUsage: If the body doesn't match the schema.
     """
-    Verify requested hosts against acceptable hosts env variable.
+    try:
+        return validator(data)
+    except JsonSchemaException as err:
+        raise InvalidUsage(err.message)
+
 
-    1) This checks to ensure that the number of requested hosts is not
-    greater than the number of valid hosts, followed by
-    2) a check to ensure each requested host is in the valid hosts env var.
+async def runBlocking(fn: Callable, *args: Any) -> Any:
+    """
+    Run a blocking call (libvirt-python is synchronous) in the libvirt thread
+    pool so that calls to several hosts may overlap.
 
     Args:
-        Any number of hosts.
+        fn: The blocking callable.
+        args: Positional arguments to pass to `fn`.
 
     Returns:
-        `True` if it's a valid host, as compared against the env.
+        Whatever `fn` returns.
     """
-    return len(hosts) <= env['VALID_HOSTS_MAX'] and all(host in env['VALID_HOSTS'] for host in hosts)
+    return await get_running_loop().run_in_executor(_EXECUTOR, fn, *args)
+
+
+async def gatherHosts(fn: Callable, hosts: List[str],
+                      *args: Any) -> Tuple[Dict[str, Any], Dict[str, str]]:
+    """
+    Run a blocking per-host call against several hosts at once, so that one
+    unreachable host doesn't fail the whole request.
+
+    Args:
+        fn: The blocking callable, taking the host as its first argument.
+        hosts: Hosts to run `fn` against.
+        args: Further positional arguments to pass to `fn`.
+
+    Returns:
+        The results of `fn` for the hosts that succeeded, and the libvirt error
+        message for those that didn't, both keyed on host.
+    """
+    results = await gather(*(runBlocking(fn, host, *args) for host in hosts),
+                           return_exceptions=True)
+
+    succeeded = dict()
+    failed = dict()
+    for host, result in zip(hosts, results):
+        if isinstance(result, libvirtError):
+            failed[host] = result.get_error_message()
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            succeeded[host] = result
+
+    return succeeded, failed
+
+
+def ojsonify(obj: Any) -> Response:
+    """
+    Drop-in for `jsonify` that serializes with orjson, which encodes straight to
+    bytes and is considerably faster than the standard library.
+
+    Args:
+        obj: A JSON-serializable object.
+
+    Returns:
+        An 'application/json' response.
+    """
+    return Response(orjson.dumps(obj), mimetype='application/json')
+
+
+def etagMatches(etag: str) -> bool:
+    """
+    Check a request's If-None-Match header against an ETag. The header may hold
+    a list of tags, weak ones among them, or '*'.
+
+    Args:
+        etag: The current (unquoted) ETag of the resource.
+
+    Returns:
+        True if the client's copy is current.
+    """
+    return parse_etags(request.headers.get('If-None-Match')).contains_weak(etag)
+
+
+def _openConnection(host: str) -> None:
+    """
+    Open a pooled connection to a host and make sure it answers.
+    """
+    with POOL.connection(host) as lv:
+        lv.getHypervisorType()
+
+
+@app.before_serving
+async def warmPool() -> None:
+    """
+    Connect to every valid host before serving, so that the first request to
+    each doesn't pay for the SSH handshake. A host that can't be reached is
+    simply connected to on first use instead, and a slow one isn't waited on
+    past `_WARM_POOL_TIMEOUT`.
+    """
+    startEventLoop()
+    connects = [ensure_future(runBlocking(_openConnection, host)) for host in env['VALID_HOSTS']]
+    if not connects:
+        return
+    # Failures are fine here, but their exceptions still have to be retrieved
+    # so asyncio doesn't log them as never retrieved.
+    for connect in connects:
+        connect.add_done_callback(lambda f: f.cancelled() or f.exception())
+    await wait(connects, timeout=_WARM_POOL_TIMEOUT)
+
+
+@app.after_serving
+async def closePool() -> None:
+    """
+    Close the connections to every host on shutdown.
+    """
+    await runBlocking(POOL.closeAll)
 
 
 @app.errorhandler(InvalidUsage)
@@ -63,30 +235,92 @@ def handle_invalid_usage(error: InvalidUsage) -> Any:
     """
     Error handler for invalid usage of this API.
     """
-    response = jsonify(error.to_dict())
+    response = ojsonify(error.to_dict())
     response.status_code = error.status_code
     return response
 
 
 @app.route('/api/', methods=['GET'])
 @app.route('/', methods=['GET'])
-def index() -> str:
+async def index() -> Response:
+    """
+    Return the main API web page (held in the server's memory), or a '304 if
+    the client's copy is still current.
+    """
+    if etagMatches(_INDEX_ETAG):
+        response = Response(b'', status=HTTPStatus.NOT_MODIFIED)
+    else:
+        response = Response(_INDEX, mimetype='text/html')
+    response.set_etag(_INDEX_ETAG)
+    return response
+
+
+@cached(cache=TTLCache(maxsize=256, ttl=env['HOST_CACHE_TTL']), lock=Lock())
+def _hostCall(host: str, method: str) -> Any:
     """
-    Return the main API web page (cached once accessed for an hour in the
-    server's memory).
+    Call an argument-less `LVConn` method on a host and cache the result for a
+    few seconds, so bursts of polling requests only reach libvirt once.
+
+    Args:
+        host: The host to connect to.
+        method: Name of the `LVConn` method to call.
+
+    Returns:
+        Whatever the method returns.
     """
-    ind = asyncCachedTimedFileIO('static_html_pages/index.html')
-    return ind
+    with POOL.connection(host) as lv:
+        return getattr(lv, method)()
+
+
+def _listDomains(host: str, status: Optional[str]) -> List[str]:
+    """
+    Get the VMs on a single host.
+
+    Args:
+        host: The host to connect to.
+        status: One of 'active' or 'inactive', or `None` for all domains.
+
+    Returns:
+        A list of domain names on this host.
+    """
+    if status == 'active':
+        return _hostCall(host, 'getActiveDomains')
+    elif status == 'inactive':
+        return _hostCall(host, 'getInactiveDomains')
+    else:
+        return _hostCall(host, 'getDomains')
+
+
+async def _streamDomains(hosts: List[str], status: Optional[str]) -> AsyncIterator[bytes]:
+    """
+    Stream the VMs on each host as a line of JSON, in the order the hosts answer
+    rather than the order they were requested in.
+
+    Args:
+        hosts: Hosts to list the VMs of.
+        status: One of 'active' or 'inactive', or `None` for all domains.
+
+    Yields:
+        A line of JSON per host.
+    """
+    async def listHost(host: str) -> Dict[str, Any]:
+        try:
+            return {'host': host, 'VMs': await runBlocking(_listDomains, host, status)}
+        except libvirtError as err:
+            return {'host': host, 'error': err.get_error_message()}
+
+    for listing in as_completed([listHost(host) for host in hosts]):
+        yield orjson.dumps(await listing) + b'\n'
 
 
 @app.route('/api/list', methods=['POST'])
-def lst() -> Response:
+async def lst() -> Response:
     """
     List all available VMs across the listed hosts. Return a '400 error if
     a host does not exist.
 
     Request format:
-        /api/list?hosts=<host 1>,<host 2>&status=[active|inactive]
+        /api/list?hosts=<host 1>,<host 2>&status=[active|inactive]&stream=[true|false]
 
     Returns:
         A JSON string of schema
@@ -97,45 +331,47 @@ def lst() -> Response:
                     "VM_1",
                     ...
                 ]
+            },
+            "errors": {
+                "<host>": "<error message>"
             }
         }
 
         containing a list of either active, inactive, or simply all VMs across the
-        defined list of hosts in env.
-    """
-    data = request.get_json()
+        defined list of hosts in env. "errors" is only present if some hosts
+        couldn't be reached.
 
-    if not data:
-        raise InvalidUsage('Please provide a list of VMs.')
+        If `stream` is set, newline-delimited JSON objects of schema
 
-    if 'hosts' not in data or not data['hosts']:
-        raise InvalidUsage('Must list hosts.')
-    elif not checkValidHosts(*data['hosts']):
-        raise InvalidUsage('Must provide valid hosts')
+        {"host": "<host>", "VMs": ["VM_1", ...]}
+
+        or, if the host couldn't be reached,
+
+        {"host": "<host>", "error": "<error message>"}
+
+        are instead streamed back one per host, as each host answers.
+    """
+    data = validate(validateList, await getJSON())
 
+    status = data.get('status')
+    # The schema rejects repeated hosts, so each is only fanned out to once.
     hosts = data['hosts']
-    VMs = []
-    if 'status' in data:
-        for host in hosts:
-            with LVConn(f'qemu+ssh://{host}/system') as lv:
-                if data['status'] == 'active':
-                    VMs += lv.getActiveDomains()
-                elif data['status'] == 'inactive':
-                    VMs += lv.getInactiveDomains()
-                else:
-                    raise InvalidUsage(
-                        'Must specify content \'active\' or \'inactive.\''
-                    )
-        return jsonify({'VMs': {data['status']: VMs}})
-    else:
-        for host in hosts:
-            with LVConn(f'qemu+ssh://{host}/system') as lv:
-                VMs += lv.getDomains()
-        return jsonify({'VMs': {'all': VMs}})
+
+    if data.get('stream'):
+        return Response(_streamDomains(hosts, status), mimetype='application/x-ndjson')
+
+    hostVMs, errors = await gatherHosts(_listDomains, hosts, status)
+    VMs = list(chain.from_iterable(hostVMs.values()))
+
+    body = {'VMs': {status or 'all': VMs}}
+    if errors:
+        body['errors'] = errors
+
+    return ojsonify(body)
 
 
 @app.route('/api/xml', methods=['POST'])
-def xml() -> Response:
+async def xml() -> Response:
     """
     Get VMs' XML template from one particular host.
 
@@ -151,62 +387,113 @@ def xml() -> Response:
         A JSON object of schema
 
         {
-            <host>:
+            <host>: {
                 "guestTemplates": [
                     {
                         <VM_1>: "template",
                     }
                     ...
-                ]
+                ],
+                "errors": {
+                    <VM_2>: "<error message>"
+                }
+            }
         }
+
+        streamed a template at a time, as each is fetched from the host. A guest
+        whose template couldn't be fetched maps to null, with the reason under
+        "errors", which is only present if some fetches failed. A host that
+        can't be reached fails the whole request with a 502.
     """
-    data = request.get_json()
+    data = validate(validateXML, await getJSON())
 
-    if 'guests' not in data:
-        raise InvalidUsage(
-            'Must provide a VM name or list of VMs from a host'
-        )
+    # Just default to my primary host.
+    host = data.get('host', env['DEFAULT_HOST'])
 
-    if 'host' in data:
-        if checkValidHosts(data['host']):
-            host = data['host']
-        else:
-            raise InvalidUsage('Must provide a single valid host.')
-    else:
-        # Just default to my primary host.
-        host = env['DEFAULT_HOST']
+    # Connect before committing to a 200, so that an unreachable host gets a
+    # proper error status instead of a truncated body.
+    try:
+        lv = await runBlocking(POOL.acquire, host)
+    except libvirtError as err:
+        raise InvalidUsage(err.get_error_message(), status_code=HTTPStatus.BAD_GATEWAY)
 
-    xml = dict()
-    xml['guestTemplates'] = []
-    with LVConn(f'qemu+ssh://{host}/system') as lv:
-        for vm in data['guests']:
-            xml['guestTemplates'].append({vm: lv.getXML(vm)})
+    async def generateTemplates() -> AsyncIterator[bytes]:
+        errors = dict()
+        error = None
 
-    return jsonify({data['host']: xml})
+        # Libvirt connections are thread-safe and multiplex their RPCs, so queue
+        # every template up front, a few in flight at a time, and stream them
+        # back in order as they arrive.
+        inFlight = Semaphore(_XML_FETCHES)
 
+        async def fetchXML(vm: str) -> str:
+            async with inFlight:
+                return await runBlocking(lv.getXML, vm)
 
-@cached(cache=TTLCache(maxsize=1, ttl=env['UPTIME_CACHE_TTL']))
-def uptimeCache() -> Dict[str, List[float]]:
+        fetches = [ensure_future(fetchXML(vm)) for vm in data['guests']]
+        try:
+            yield b'{' + orjson.dumps(host) + b': {"guestTemplates": ['
+            for i, (vm, fetch) in enumerate(zip(data['guests'], fetches)):
+                try:
+                    template = await fetch
+                except libvirtError as err:
+                    template = None
+                    errors[vm] = err.get_error_message()
+                    error = err
+                yield (b', ' if i else b'') + orjson.dumps({vm: template})
+            yield b']' + (b', "errors": ' + orjson.dumps(errors) if errors else b'') + b'}}'
+        finally:
+            # Don't let go of the connection while it's still in use.
+            await gather(*fetches, return_exceptions=True)
+            POOL.release(host, lv, error)
+
+    return Response(generateTemplates(), mimetype='application/json')
+
+
+async def _readUptime() -> Dict[str, List[float]]:
     """
-    Read the uptime on-disk cache and cache it in memory for quicker
-    access.
+    Read the uptime on-disk cache (without blocking the event loop) through
+    Redis, so that it's read from disk once per TTL by a single worker instead
+    of once by every worker. Concurrent misses within a worker share one read.
     """
-    with open(env['UPTIME_CACHE'], 'r') as fh:
-        loadAvgs = literal_eval(fh.read().replace('\n', ''))
+    global _uptimeLock
+    if _uptimeLock is None:
+        # Created on first use, so that it's bound to the serving loop.
+        _uptimeLock = AsyncLock()
+
+    async with _uptimeLock:
+        data = await runBlocking(_REDIS.get, _UPTIME_KEY)
+        if data is not None:
+            return orjson.loads(data)
 
-    for server in loadAvgs:
-        loadAvgs[server] = loadAvgs[server].split(', ')
+        async with aiofiles.open(env['UPTIME_CACHE'], 'rb') as fh:
+            data = await fh.read()
+
+        # If this raises a 500 error to the end user, it's a sign the env
+        # was not set up properly. Don't share a bad read with other workers.
+        try:
+            loadAvgs = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            abort(HTTPStatus.INTERNAL_SERVER_ERROR)
+        if not isinstance(loadAvgs, dict) or not env['VALID_HOSTS'].issuperset(loadAvgs):
+            abort(HTTPStatus.INTERNAL_SERVER_ERROR)
 
-    # If this raises a 500 error to the end user, it's a sign the env
-    # was not set up properly.
-    if not all(server in env['VALID_HOSTS'] for server in loadAvgs):
-        abort(HTTPStatus.INTERNAL_SERVER_ERROR)
+        await runBlocking(_REDIS.setex, _UPTIME_KEY, int(env['UPTIME_CACHE_TTL']), data)
 
     return loadAvgs
 
 
+@AsyncTTL(time_to_live=env['UPTIME_LOCAL_CACHE_TTL'])
+async def uptimeCache() -> Dict[str, List[float]]:
+    """
+    Get the hosts' load averages, cached in memory for a few seconds on top of
+    the cache shared through Redis.
+    """
+    return await _readUptime()
+
+
 @app.route('/api/resources', methods=['POST'])
-def resources() -> Response:
+async def resources() -> Response:
     """
     Get the resources available on a list of hosts.
 
@@ -220,29 +507,35 @@ def resources() -> Response:
 
         TODO: Fill out schema once #6 above has been resolved.
     """
-    data = request.get_json()
-    if not data:
-        data['hosts'] = env['DEFAULT_HOST']
-    if not checkValidHosts(*data['hosts']):
-        raise InvalidUsage('Must provide valid hosts.')
+    # The body's optional; the schema defaults to my primary host.
+    data = validate(validateResources, await getJSON() or {})
+
+    # The schema rejects repeated hosts, so each is only fanned out to once.
+    hosts = data['hosts']
+    snapshots, errors = await gatherHosts(_hostCall, hosts, 'getHostSnapshot')
+
+    loadAvgs = await uptimeCache()
 
     hostResources = dict()
-    for host in data['hosts']:
-        hostState = {}
+    for host, snapshot in snapshots.items():
+        # A host missing from the uptime cache (e.g. one cache_uptime.sh doesn't
+        # poll) just has no load averages, rather than failing the request.
+        hostResources[host] = {
+            'activeCores': snapshot.activeCores,
+            'requestedMemory': snapshot.requestedMemory,
+            'memoryStats': snapshot.memoryStats,
+            'hostCPULoadAverages': loadAvgs.get(host)
+        }
 
-        with LVConn(f'qemu+ssh://{host}/system') as lv:
-            hostState['activeCores'] = lv.getActiveCores()
-            hostState['requestedMemory'] = lv.getRequestedMemory()
-            hostState['memoryStats'] = lv.getHostMemoryStats()
-        hostState['hostCPULoadAverages'] = uptimeCache()[host]
-        
-        hostResources[host] = hostState
+    body = {'hosts': hostResources}
+    if errors:
+        body['errors'] = errors
 
-    return jsonify({'hosts': hostResources})
+    return ojsonify(body)
 
 
 @app.route('/api/create', methods=['POST'])
-def create() -> Response:
+async def create() -> Response:
     """
     Create a VM on a particular host.
 
@@ -261,87 +554,76 @@ def create() -> Response:
         A JSON object of the schema
 
         {
-            "<host>": {
-                "template": "<XML doc from the guest>"
-            }
+            "job": "<job ID>"
         }
+
+        with a '202 status. Poll `/api/create/status/<job ID>` for the result.
     """
-    data = request.get_json()
-    print(data)
-    # Validate all of our input fields.
-    if 'host' in data:
-        if checkValidHosts(data['host']):
-            host = f'root@{data["host"]}'
-        else:
-            raise InvalidUsage('Must provide a single valid host.')
-    else:
-        # Just default to my primary host.
-        host = f'root@{env["DEFAULT_HOST"]}'
+    data = validate(validateCreate, await getJSON())
+    app.logger.debug('create payload: %s', data)
 
-    if 'guestName' in data and data['guestName']:
-        guestName = data['guestName']
-    else:
-        raise InvalidUsage('Must provide a valid guest VM name.')
+    # The schema fills in the defaults (e.g. my primary host).
+    host = f'root@{data["host"]}'
 
-    if 'ipAddress' in data:
-        try:
-            ipAddress = str(ip_address(data['ipAddress']))
-        except ValueError as err:
-            abort(HTTPStatus.BAD_REQUEST)
-            ipAddress = None
-    else:
-        raise InvalidUsage(
-            'Must provide a valid IP address to assign the guest VM.'
-        )
+    # Now let's queue the VM's creation. The job's referenced by name, as only
+    # the RQ worker needs to import it.
+    job = await runBlocking(_QUEUE.enqueue, 'tasks.createVM', host, data['datasetName'],
+                            data['sourceSnapshot'], data['guestName'], data['ipAddress'],
+                            data['bridge'], data['memory'], data['cpus'], data['template'])
 
-    if 'datasetName' in data and data['datasetName']:
-        dataset = data['datasetName']
-    else:
-        raise InvalidUsage('Must provide a valid dataset name to contain VM.')
+    return ojsonify({'job': job.id}), HTTPStatus.ACCEPTED
 
-    if 'sourceSnapshot' in data and data['sourceSnapshot']:
-        sourceSnapshot = data['sourceSnapshot']
-    else:
-        sourceSnapshot = env['DEFAULT_SNAPSHOT']
 
-    if 'bridge' in data and data['bridge']:
-        bridge = data['bridge']
-    else:
-        raise InvalidUsage('Must define bridge interface to use')
+def _jobStatus(jobID: str) -> Dict[str, Any]:
+    """
+    Look up a queued VM creation job.
 
-    if 'memory' in data and data['memory']:
-        try:
-            memory = int(data['memory'])
-        except TypeError as err:
-            abort(HTTPStatus.BAD_REQUEST)
-            memory = None
-    else:
-        memory = 1024
+    Args:
+        jobID: ID of the job returned by `/api/create`.
 
-    if 'cpus' in data and data['cpus']:
-        try:
-            cpus = int(data['cpus'])
-        except TypeError as err:
-            abort(HTTPStatus.BAD_REQUEST)
-            cpus = None
-    else:
-        cpus = 1
+    Returns:
+        The job's status and, once it's finished, the resulting template, or why
+        it failed.
+    """
+    try:
+        job = Job.fetch(jobID, connection=_REDIS)
+    except NoSuchJobError:
+        raise InvalidUsage('No such job.', status_code=HTTPStatus.NOT_FOUND)
 
-    if 'template' in data and data['template']:
-        template = data['template']
-    else:
-        template = 'ubuntu'
+    status = {'status': job.get_status(), 'template': job.result}
+    if job.is_failed:
+        status['error'] = job.meta.get('error', 'VM creation failed.')
+
+    return status
+
+
+@app.route('/api/create/status/<jobID>', methods=['GET'])
+async def createStatus(jobID: str) -> Response:
+    """
+    Get the status of a VM creation job.
+
+    Request format:
 
-    # Now let's create the VM.
-    with LVConn(f'qemu+ssh://{host}/system') as lv:
-        template = run(lv.createVM(dataset, sourceSnapshot, guestName, ipAddress,
-                                   bridge, memory, cpus, template))
+        /api/create/status/<job ID>
 
-    return jsonify({'VM': {'template': template}})
+    Returns:
+        A JSON object of the schema
+
+        {
+            "VM": {
+                "status": "<queued|started|finished|failed>",
+                "template": "<XML doc from the guest, once finished>",
+                "error": "<error message>"
+            }
+        }
+
+        "error" is only present once the job has failed.
+    """
+    return ojsonify({'VM': await runBlocking(_jobStatus, jobID)})
 
 
 @app.route('/api/state', methods=['POST'])
-def state() -> Response:
+async def state() -> Response:
     """
     Make state calls to defined domains (e.g., similar to
     `virsh (start|destroy|undefine|stop)`.
@@ -0,0 +1 @@
+rq worker --url redis://localhost:6379/0
\ No newline at end of file
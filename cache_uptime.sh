@@ -1,7 +1,7 @@
 #! /bin/bash
-# Reach out to my domains and cache their load averages to file. Goal is to make the
-# resulting format as close to Python dict as possible from the outset. This needs to
-# be a cronjob, of course - otherwise these values never update :shrug:
+# Reach out to my domains and cache their load averages to file as JSON, mapping each
+# domain to a list of its 1, 5 and 15 minute load averages. This needs to be a
+# cronjob, of course - otherwise these values never update :shrug:
 
 domains=(
     "perchost.bjd2385.com"
@@ -11,20 +11,31 @@ domains=(
 
 cachefile="/tmp/uptime.cache"
 
-truncate -s 0 "$cachefile"
+# Build the new cache beside the old one and move it into place at the end, so
+# the API never reads a half-written file.
+tmpfile="$(mktemp "${cachefile}.XXXXXX")"
+trap 'rm -f "$tmpfile"' EXIT
 
-echo "{" >> "$cachefile"
+echo "{" >> "$tmpfile"
 
+# JSON doesn't allow a trailing comma, so only separate entries after the first.
+sep=""
 for dom in ${domains[@]}
 do
     if [ "$dom" = "$(hostname)" ]
     then
         # No need for SSH.
-        echo "\"${dom}\":\"$(uptime | grep -oP "load average: \K.*")\"," >> "$cachefile"
+        loadavg="$(uptime | grep -oP "load average: \K.*")"
     else
         # We need to have SSH access to acquire the uptime.
-        echo "\"${dom}\":\"$(ssh "$dom" uptime | grep -oP "load average: \K.*")\"," >> "$cachefile"
+        loadavg="$(ssh "$dom" uptime | grep -oP "load average: \K.*")"
     fi
+    echo "${sep}\"${dom}\":[${loadavg}]" >> "$tmpfile"
+    sep=","
 done
 
-echo "}" >> "$cachefile"
+echo "}" >> "$tmpfile"
+
+# mktemp creates the file 0600, but the API may run as another user.
+chmod 644 "$tmpfile"
+mv "$tmpfile" "$cachefile"
@@ -8,10 +8,14 @@ bind = '0.0.0.0:5000'
 
 # Maximum number of backlog requests to hold onto before users get error messages.
 backlog = 100
-workers = cpu_count() * 2 + 1
 
-# Do not support persistent connections. Close after each request.
-worker_class = 'sync'
+# Each worker serves many requests concurrently and keeps its own libvirt
+# connection to every host, so more workers than cores only adds connections.
+workers = max(2, cpu_count())
+
+# The app is ASGI (Quart); each Uvicorn worker runs an event loop, so it can
+# have many libvirt calls in flight at once rather than one request at a time.
+worker_class = 'uvicorn.workers.UvicornWorker'
 
 # Kill a worker if it does not report to the master process.
 timeout = 30
@@ -17,17 +17,69 @@ TODO:
         - https://unix.stackexchange.com/a/396383
 """
 
-from typing import List, Any, Dict, Optional, Union, Tuple
-from operator import itemgetter
+from typing import List, Any, Dict, Optional, Union, Tuple, Iterator
+from contextlib import contextmanager
+from threading import Lock, Thread
+from dataclasses import dataclass
+from jinja2 import Template
+from xml.etree import ElementTree
+from asyncio import get_running_loop, gather
 
 from pool import DatasetManager
 from settings import env
-from utils import asyncCachedTimedFileIO
+from utils import asyncCachedTemplate
 
 import libvirt as lv
 import socket
 import uuid
-import re
+import time
+
+# Libvirt URIs of the hosts this API may connect to.
+_HOST_URI = {host: f'qemu+ssh://{host}/system' for host in env['VALID_HOSTS']}
+
+# Names of the `virDomainState` codes `getDomainStatus` reports.
+_STATE_NAMES = {
+    lv.VIR_DOMAIN_RUNNING: 'running',
+    lv.VIR_DOMAIN_SHUTDOWN: 'shutdown',
+    lv.VIR_DOMAIN_SHUTOFF: 'shut off',
+    lv.VIR_DOMAIN_PAUSED: 'paused'
+}
+
+_eventLoopLock = Lock()
+_eventLoopThread: Optional[Thread] = None
+
+
+def _runEventLoop() -> None:
+    while True:
+        lv.virEventRunDefaultImpl()
+
+
+def startEventLoop() -> None:
+    """
+    Register libvirt's default event loop implementation and run it in a daemon
+    thread, so connections can use keepalives (and receive events). Must be
+    called before any connections are opened; later calls do nothing.
+    """
+    global _eventLoopThread
+    with _eventLoopLock:
+        if _eventLoopThread is not None:
+            return
+        lv.virEventRegisterDefaultImpl()
+        _eventLoopThread = Thread(target=_runEventLoop, name='libvirt-events', daemon=True)
+        _eventLoopThread.start()
+
+
+@dataclass(frozen=True)
+class HostSnapshot:
+    """
+    The resources used by a host's domains, as gathered by `LVConn.getHostSnapshot`.
+    """
+    # Sum of vCPUs assigned to active domains.
+    activeCores: int
+    # Sum of memory (in kB) requested by active domains.
+    requestedMemory: int
+    # Memory stats of each active domain.
+    memoryStats: Dict[str, Dict[str, int]]
 
 
 class LVConn:
@@ -35,18 +87,29 @@ class LVConn:
     CM / wrapper for libvirt to make local system calls and extract
     information about domains.
     """
-    _hostR = re.compile(r'(?<=//)[a-zA-Z0-9.@]*(?=/system)')
+    # Seconds a looked-up domain handle (or its XML) is reused for before looking
+    # it up again.
+    _domainCacheTTL = 5
 
-    def __init__(self, system: str ='qemu:///system') -> None:
+    def __init__(self, system: str ='qemu:///system', readOnly: bool =False) -> None:
         # Other hosts may be referenced as
         # 'qemu+ssh://<hostname>/system <command>'
         self.system = system
 
-        host = re.search(LVConn._hostR, system)
-        if host:
-            self.host = host.group(0)
-        else:
-            self.host = env['DEFAULT_HOST']
+        # Read-only connections can only query the host, not change domains.
+        self.readOnly = readOnly
+
+        # Domain handles by name or ID, along with when they expire.
+        self._domainCache: Dict[Union[str, int], Tuple[float, lv.virDomain]] = dict()
+
+        # Domains' XML by name, along with when it expires. Domains change outside
+        # this connection too (other workers, virsh, guests shutting down), so
+        # this only absorbs bursts of polling.
+        self._xmlCache: Dict[str, Tuple[float, str]] = dict()
+
+        # The host sits between '//' and '/system', and is empty for local URIs.
+        host = system.partition('//')[2].partition('/system')[0]
+        self.host = host or env['DEFAULT_HOST']
 
     def __enter__(self) -> 'LVConn':
         """
@@ -57,11 +120,23 @@ class LVConn:
             libvirt.libvirtError: If a connection to the desired host could not be
             established.
         """
-        self.conn = lv.open(self.system)
+        if self.readOnly:
+            self.conn = lv.openReadOnly(self.system)
+        else:
+            self.conn = lv.open(self.system)
         if not self.conn:
             raise lv.libvirtError(f'Could not open connection to {self.system}.')
         return self
 
+    def primeDomainCache(self) -> None:
+        """
+        Fill the domain cache from a single listing, so that the first lookups by
+        name don't each make an RPC. Only worth it for long-lived connections.
+        """
+        expires = time.monotonic() + LVConn._domainCacheTTL
+        for dom in self.conn.listAllDomains():
+            self._domainCache[dom.name()] = (expires, dom)
+
     def __exit__(self, *args: Any) -> None:
         self.close()
 
@@ -75,7 +150,7 @@ class LVConn:
         Returns:
             A list of all domains, regardless of state, indexed on this host.
         """
-        return list(map(lambda d: d.name(), self.conn.listAllDomains()))
+        return [d.name() for d in self.conn.listAllDomains()]
 
     def getActiveDomains(self) -> List[str]:
         """
@@ -84,41 +159,52 @@ class LVConn:
         Returns:
             A list of running domains.
         """
-        runningDomains = []
-
-        # To get the state codes, see `virDomainState` enum defined in
-        # https://libvirt.org/html/libvirt-libvirt-domain.html
-        for dom in self.getDomains():
-            if self.conn.lookupByName(dom).state()[0] == 1:
-                runningDomains.append(dom)
-
-        return runningDomains
+        return [d.name() for d in self.conn.listAllDomains(lv.VIR_CONNECT_LIST_DOMAINS_RUNNING)]
 
-    def _getActiveDomainObjects(self) -> List[lv.virDomain]:
+    def getInactiveDomains(self) -> List[str]:
         """
-        Produce domain objects instead of a list of names.
-
-        It's a fortunate (?) coincidence that `listDomainsID` appears to only return
-        IDs of VMs that are currently active on the node.
+        Opposite of `getActiveDomains`.
         
         Returns:
-            A list of active libvirt virtual domain objects for further 
-            interaction / method calls.
+            A list of names of inactive (not running) domains.
         """
-        activeDomainIDs = self.conn.listDomainsID()
-        activeDomainObjs = []
-        for domainID in activeDomainIDs:
-            activeDomainObjs.append(self.conn.lookupByID(domainID))
-        return activeDomainObjs
+        # Anything not running, e.g. shut off or paused.
+        flags = lv.VIR_CONNECT_LIST_DOMAINS_PAUSED | lv.VIR_CONNECT_LIST_DOMAINS_SHUTOFF \
+            | lv.VIR_CONNECT_LIST_DOMAINS_OTHER
+        return [d.name() for d in self.conn.listAllDomains(flags)]
 
-    def getInactiveDomains(self) -> List[str]:
+    def _lookup(self, domain: Union[str, int]) -> lv.virDomain:
         """
-        Opposite of `getActiveDomains`.
-        
+        Look up a domain by name or by ID, reusing the handle from a recent lookup
+        of the same domain.
+
+        Args:
+            domain: Name or ID of the domain.
+
         Returns:
-            A list of names of inactive (not running) domains.
+            The libvirt domain object.
+        """
+        cached = self._domainCache.get(domain)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        if isinstance(domain, str):
+            dom = self.conn.lookupByName(domain)
+        else:
+            dom = self.conn.lookupByID(domain)
+
+        self._domainCache[domain] = (time.monotonic() + LVConn._domainCacheTTL, dom)
+        return dom
+
+    def _forget(self, domain: Union[str, int]) -> None:
         """
-        return list(set(self.getDomains()) - set(self.getActiveDomains()))
+        Drop what's cached about a domain once it's been changed.
+
+        Args:
+            domain: Name or ID the domain was changed through.
+        """
+        self._domainCache.pop(domain, None)
+        self._xmlCache.pop(domain, None)
 
     def getXML(self, domain: Union[str, int]) -> str:
         """
@@ -130,10 +216,17 @@ class LVConn:
         Returns:
             A string object containing the XML.
         """
-        if type(domain) is str:
-            return self.conn.lookupByName(domain).XMLDesc()
-        else:
-            return self.conn.lookupByID(domain).XMLDesc()
+        # IDs are reused by other domains, so only cache by name.
+        if not isinstance(domain, str):
+            return self._lookup(domain).XMLDesc()
+
+        cached = self._xmlCache.get(domain)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        xml = self._lookup(domain).XMLDesc()
+        self._xmlCache[domain] = (time.monotonic() + LVConn._domainCacheTTL, xml)
+        return xml
 
     def getPoolXML(self, domain: Union[str, int]) -> str:
         """
@@ -145,38 +238,76 @@ class LVConn:
         Returns:
             A string containing the XML.
         """
-        if type(domain) is str:
-            return self.conn.lookupByName(domain).
+        return self.conn.storagePoolLookupByName(domain).XMLDesc()
+
+    def _allStats(self) -> List[Tuple[lv.virDomain, Dict[str, Any]]]:
+        """
+        Get the vCPU and balloon (memory) stats of every active domain in a single
+        call, rather than an `info` / `memoryStats` call per domain.
+
+        Returns:
+            Pairs of active domains and their stats.
+        """
+        return self.conn.getAllDomainStats(
+            stats=lv.VIR_DOMAIN_STATS_VCPU | lv.VIR_DOMAIN_STATS_BALLOON,
+            flags=lv.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE
+        )
+
+    @staticmethod
+    def _balloonStats(stats: Dict[str, Any]) -> Dict[str, int]:
+        """
+        Reshape a domain's bulk balloon stats (e.g. `balloon.swap_in`) to match
+        what `virDomain.memoryStats` returns (e.g. `swap_in`).
+        """
+        memoryStats = dict()
+        for key, value in stats.items():
+            if not key.startswith('balloon.') or key == 'balloon.maximum':
+                continue
+            name = key[len('balloon.'):].replace('-', '_')
+            memoryStats['actual' if name == 'current' else name] = value
+        return memoryStats
 
     def getActiveCores(self) -> int:
         """
         Get the number of assigned cores to VMs.
         """
-        cpuCount = itemgetter(3)
-        domObjs = self._getActiveDomainObjects()
-        domObjsInfo = map(lambda obj: obj.info(), domObjs)
-        count = sum(map(cpuCount, domObjsInfo))
-        return count
+        return sum(stats['vcpu.current'] for _, stats in self._allStats())
 
     def getRequestedMemory(self) -> int:
         """
         Return a sum of requested memory of active VMs (in kB) for a particular
         host.
         """
-        kb = 0
-        for domain in self._getActiveDomainObjects():
-            kb += domain.maxMemory()
-        return kb
+        return sum(stats['balloon.maximum'] for _, stats in self._allStats())
 
     def getHostMemoryStats(self) -> Dict[str, Dict[str, int]]:
         """
         Return the memory status.
         """
-        domains = dict()
-        for domain in self._getActiveDomainObjects():
-            memStats = domain.memoryStats()
-            domains[domain.name()] = memStats
-        return domains
+        return {domain.name(): self._balloonStats(stats)
+                for domain, stats in self._allStats()}
+
+    def getHostSnapshot(self) -> HostSnapshot:
+        """
+        Get the same resources as `getActiveCores`, `getRequestedMemory` and
+        `getHostMemoryStats`, from one bulk stats call.
+
+        Returns:
+            A `HostSnapshot` of the host.
+        """
+        cores = 0
+        kb = 0
+        memoryStats = dict()
+        for domain, stats in self._allStats():
+            cores += stats['vcpu.current']
+            kb += stats['balloon.maximum']
+            memoryStats[domain.name()] = self._balloonStats(stats)
+
+        return HostSnapshot(
+            activeCores=cores,
+            requestedMemory=kb,
+            memoryStats=memoryStats
+        )
 
     def getHypervisorType(self) -> str:
         """
@@ -194,21 +325,9 @@ class LVConn:
         Returns:
             The domain's status, as a string (e.g., 'running' or 'suspended')
         """
-        if type(domain) is str:
-            state = self.conn.lookupByName(domain).state()
-        else:
-            state = self.conn.lookupByID(domain).state()
-
-        if state == lv.VIR_DOMAIN_RUNNING:
-            return 'running'
-        elif state == lv.VIR_DOMAIN_SHUTDOWN:
-            return 'shutdown'
-        elif state == lv.VIR_DOMAIN_SHUTOFF:
-            return 'shut off'
-        elif state == lv.VIR_DOMAIN_PAUSED:
-            return 'paused'
-        else:
-            return f'unsupported domain state: {state}'
+        # `state` gives [state, reason].
+        state = self._lookup(domain).state()[0]
+        return _STATE_NAMES.get(state, f'unsupported domain state: {state}')
 
     def startVM(self, domain: Union[str, int]) -> str:
         """
@@ -221,16 +340,13 @@ class LVConn:
             An empty string if the VM was started without an issue, and the error
             message otherwise, to be provided in an API's feedback.
         """
-        if type(domain) is str:
-            try:
-                return self.conn.lookupByName(domain).create()
-            except lv.libvirtError as err:
-                return err.get_error_message()
-        else:
-            try:
-                return self.conn.lookupByID(domain).create()
-            except lv.libvirtError as err:
-                return err.get_error_message()
+        try:
+            result = self._lookup(domain).create()
+        except lv.libvirtError as err:
+            return err.get_error_message()
+
+        self._forget(domain)
+        return result
 
     def shutdownVM(self, domain: Union[str, int]) -> str:
         """
@@ -240,16 +356,14 @@ class LVConn:
         Args:
             domain: the respective VM / domain.
         """
-        if type(domain) is str:
-            try:
-                return self.conn.lookupByName(domain).destroy()
-            except lv.libvirtError as err:
-                return err.get_error_message()
-        else:
-            try:
-                return self.conn.lookupByID(domain).destroy()
-            except lv.libvirtError as err:
-                return err.get_error_message()
+        try:
+            result = self._lookup(domain).destroy()
+        except lv.libvirtError as err:
+            return err.get_error_message()
+
+        # A stopped domain loses its ID.
+        self._forget(domain)
+        return result
 
     def terminateVM(self, domain: Union[str, int], delete: bool =False) -> None:
         """
@@ -259,57 +373,72 @@ class LVConn:
             domain: The respective VM / domain.
             delete: If True, delete the ZFS dataset as well.
         """
-        if type(domain) is str:
-            try:
-                vmobj = self.conn.lookupByName(domain)
-            except lv.libvirtError as err:
-                return err.get_error_message()
-        else:
-            try:
-                vmobj = self.conn.lookupByID(domain)
-            except lv.libvirtError as err:
-                return err.get_error_message()
+        try:
+            vmobj = self._lookup(domain)
+        except lv.libvirtError as err:
+            return err.get_error_message()
         vmobj.destroy()
         if delete:
-            self.conn.
+            # The domain's storage pool shares its name (see `createVM`).
+            pool = self.conn.storagePoolLookupByName(vmobj.name())
+            pool.destroy()
+            pool.undefine()
         vmobj.undefine()
+        self._forget(domain)
 
-    def _createStoragePool(self, pooln: str, path: str,
-                                 fn: str =env['DEFAULT_POOL_DEFINITION_PATH']) -> str:
+    def _createStoragePool(self, pooln: str, path: str, baseDef: Template) -> str:
         """
         Create a directory-type pool in libvirt.
 
         Args:
-            fn: File name to open and cache for future use.
             pooln: Name of the pool to create (should be the host name of the VM).
             path: Path of the ZFS dataset (`zfs get mountpoint <dataset>`).
+            baseDef: The storage pool definition to fill in.
 
         Returns:
             The resulting XML configuration of the pool.
         """
-        baseDef = asyncCachedTimedFileIO(fn)
-        pool = self.conn.storagePoolDefineXML(baseDef.format(pooln, path))
+        # A retried creation may already have defined this pool; reuse it only if
+        # it's the same dataset's.
+        try:
+            pool = self.conn.storagePoolLookupByName(pooln)
+        except lv.libvirtError:
+            pool = None
+
+        if pool is not None:
+            if ElementTree.fromstring(pool.XMLDesc()).findtext('target/path') == path:
+                return pool
+
+        pool = self.conn.storagePoolDefineXML(baseDef.render(name=pooln, path=path))
         pool.setAutostart(1)
         return self.conn.storagePoolLookupByName(pooln)
 
     def _createVMFromTemplate(self, name: str, memory: int, disk: str, bridge: str,
-                cpus: int =1, template: str ='ubuntu.xml') -> Union[Tuple[str, str], str]:
+                              baseDef: Template, cpus: int =1) -> Union[Tuple[str, str], str]:
         """
-        Create a VM from the default template (for now this is only ubuntu.xml).
+        Create a VM from a template (for now this is only ubuntu.xml).
 
         Args:
             name: Name of the domain.
             memory: Memory (in MiB) to give the domain.
             disk: Path to the disk image file.
             bridge: Bridge interface to use.
+            baseDef: The VM template to fill in.
             cpus: Number of CPUs to give the domain.
 
         Returns:
             The resulting XML template for the created VM.
         """
-        baseDef = asyncCachedTimedFileIO(template)
         mem_kiB = memory * 2 ** 10
-        template = baseDef.format(name, str(uuid.uuid1()), mem_kiB, mem_kiB, cpus, disk, bridge)
+        template = baseDef.render(
+            name=name,
+            uuid=str(uuid.uuid1()),
+            memory=mem_kiB,
+            currentMemory=mem_kiB,
+            cpus=cpus,
+            disk=disk,
+            bridge=bridge
+        )
         self.conn.defineXML(template)
         return self.getXML(domain=name)
 
@@ -345,15 +474,22 @@ class LVConn:
             A string object containing the XML template that was generated for
             this created VM and pool XML template.
         """
+        # Libvirt and DNS calls block, so keep them off the event loop while the
+        # dataset commands are awaited.
+        loop = get_running_loop()
+
         if guestName and not ipAddress:
             try:
-                ipAddress = socket.gethostbyname(guestName)
+                # Each entry's (family, type, proto, canonname, (address, port)).
+                addresses = await loop.getaddrinfo(guestName, None, family=socket.AF_INET)
+                ipAddress = addresses[0][4][0]
             except socket.gaierror as err:
                 return f'Guest host name does not have a corresponding DNS A ' \
                        f'record: {err}'
         elif ipAddress and not guestName:
             try:
-                guestName = socket.gethostbyaddr(ipAddress)
+                # `gethostbyaddr` gives (host name, aliases, addresses).
+                guestName = (await loop.run_in_executor(None, socket.gethostbyaddr, ipAddress))[0]
             except socket.herror as err:
                 return f'Guest host IP address does not have corresponding DNS A ' \
                        f'record: {err}'
@@ -371,24 +507,163 @@ class LVConn:
         if error:
             return error
 
+        # Find the dataset's mount point; the templates don't depend on it, so read
+        # them in the meantime.
+        path, poolDef, vmDef = await gather(
+            dmh.getMountPoint(),
+            asyncCachedTemplate(env['DEFAULT_POOL_DEFINITION_PATH']),
+            asyncCachedTemplate(f'{env["VM_TEMPLATES_DIR"]}/{template}.xml')
+        )
+
         # Create the storage pool in LV.
-        path = await dmh.getMountPoint()
-        print(path)
-        config = self._createStoragePool(guestName, path)
+        config = await loop.run_in_executor(
+            None, self._createStoragePool, guestName, path, poolDef
+        )
 
         # Now create the VM on that storage pool.
-        vm = self._createVMFromTemplate(
+        vm = await loop.run_in_executor(
+            None,
+            self._createVMFromTemplate,
             guestName,
             memory,
             f'{path}/root.raw',
             bridge,
-            cpus,
-            f'{env["VM_TEMPLATES_DIR"]}/{template}.xml'
+            vmDef,
+            cpus
         )
 
+        # The dataset now belongs to a VM, so a later creation mustn't reuse it.
+        error = await dmh.markCreated()
+        if error:
+            return error
+
         return vm
 
 
+class LVConnPool:
+    """
+    Keep libvirt connections to hosts open between requests, as opposed to
+    opening and tearing them down (a full SSH handshake) for every request.
+
+    There's a single connection per host, shared by every thread: libvirt
+    connections are thread-safe, and the remote driver multiplexes concurrent
+    RPCs over the one SSH session.
+    """
+    # Errors after which a connection should not be handed out again.
+    _disconnectErrors = (
+        lv.VIR_ERR_SYSTEM_ERROR,
+        lv.VIR_ERR_RPC,
+        lv.VIR_ERR_NO_CONNECT,
+        lv.VIR_ERR_INVALID_CONN
+    )
+
+    # With the event loop running, probe idle connections every `_keepAliveInterval`
+    # seconds and close them after `_keepAliveCount` unanswered probes, rather
+    # than only finding out a host went away on the next call.
+    _keepAliveInterval = 5
+    _keepAliveCount = 3
+
+    def __init__(self) -> None:
+        self._conns: Dict[str, LVConn] = dict()
+        self._lock = Lock()
+        self._hostLocks: Dict[str, Lock] = dict()
+
+    def _hostLock(self, host: str) -> Lock:
+        with self._lock:
+            return self._hostLocks.setdefault(host, Lock())
+
+    def acquire(self, host: str) -> LVConn:
+        """
+        Get the open connection to a host, (re)opening it if need be. Concurrent
+        callers for the same host wait on a single handshake.
+
+        Args:
+            host: The host to connect to.
+
+        Raises:
+            KeyError: If the host isn't one of the valid hosts.
+            libvirt.libvirtError: If a new connection could not be established.
+        """
+        conn = self._conns.get(host)
+        if conn is not None and conn.conn.isAlive():
+            return conn
+
+        with self._hostLock(host):
+            conn = self._conns.get(host)
+            if conn is not None and conn.conn.isAlive():
+                return conn
+
+            # E.g. closed by a failed keepalive; replace it.
+            if conn is not None:
+                self._close(conn)
+
+            conn = LVConn(_HOST_URI[host], readOnly=True).__enter__()
+            try:
+                if _eventLoopThread is not None:
+                    conn.conn.setKeepAlive(LVConnPool._keepAliveInterval,
+                                           LVConnPool._keepAliveCount)
+                conn.primeDomainCache()
+            except lv.libvirtError:
+                self._close(conn)
+                raise
+            self._conns[host] = conn
+            return conn
+
+    def release(self, host: str, conn: LVConn,
+                error: Optional[lv.libvirtError] =None) -> None:
+        """
+        Hand back a connection once done with it. It's dropped from the pool and
+        closed if it raised a connection-level error, so that the next caller
+        reconnects.
+
+        Args:
+            host: The host the connection was acquired for.
+            conn: The acquired connection.
+            error: The libvirt error raised while using the connection, if any.
+        """
+        if error is None or error.get_error_code() not in LVConnPool._disconnectErrors:
+            return
+
+        with self._hostLock(host):
+            if self._conns.get(host) is conn:
+                del self._conns[host]
+        self._close(conn)
+
+    @staticmethod
+    def _close(conn: LVConn) -> None:
+        try:
+            conn.close()
+        except lv.libvirtError:
+            # It's likely already disconnected.
+            pass
+
+    @contextmanager
+    def connection(self, host: str) -> Iterator[LVConn]:
+        """
+        Use a host's connection for the duration of a `with` block.
+        """
+        conn = self.acquire(host)
+        error = None
+        try:
+            yield conn
+        except lv.libvirtError as err:
+            error = err
+            raise
+        finally:
+            self.release(host, conn, error)
+
+    def closeAll(self) -> None:
+        """
+        Close every connection in the pool.
+        """
+        with self._lock:
+            conns = list(self._conns.values())
+            self._conns.clear()
+
+        for conn in conns:
+            self._close(conn)
+
+
 if __name__ == '__main__':
     import asyncio
 
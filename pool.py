@@ -6,14 +6,19 @@ Simple ZPool dataset manager for VMs.
 """
 
 from typing import List, Optional
-from asyncio.subprocess import PIPE, create_subprocess_shell
+from asyncio.subprocess import PIPE, create_subprocess_exec
 
 from settings import env
 
-import re
+import shlex
 
-# RE
-newlines = re.compile(r'\n+')
+# Share one SSH connection per host between commands (and instances), rather than
+# a handshake per command; it's kept open for a minute after the last command. The
+# control socket lives in the user's own ~/.ssh, where others can't plant one.
+_SSH_OPTIONS = '-o ControlMaster=auto -o ControlPath=~/.ssh/cm-%C -o ControlPersist=60'
+
+# ZFS user property tracking whether a clone's VM creation has finished.
+_STATE_PROPERTY = 'vmapi:state'
 
 
 class DatasetManager:
@@ -24,42 +29,86 @@ class DatasetManager:
 
     def __init__(self, machineImage: str, datasetName: str, host: Optional[str] =None) -> None:
         self.machineImage = machineImage
-        self.datasetName = datasetName
-        self.hostString = f'ssh {host} ' if host else ''
-
-        if len(self.datasetName) > 1 and self.datasetName[-1] == '/':
-            self.datasetName = self.datasetName[:-1]
+        self.datasetName = datasetName.rstrip('/')
+        self.sshArgs = ['ssh', *_SSH_OPTIONS.split(), host] if host else []
+        self._mountPoint: Optional[str] = None
 
-    @staticmethod
-    async def _getIO(command: str) -> List[str]:
+    async def _getIO(self, *command: str) -> List[str]:
         """
-        Get results from terminal commands as lists of lines of text.
+        Get results from commands (run on the remote host, if there is one) as
+        lists of lines of text. Locally, they're executed directly rather than
+        through a shell.
         """
-        proc = await create_subprocess_shell(command, shell=True, stdout=PIPE, stderr=PIPE)
+        # ssh joins the arguments for the remote shell to parse again.
+        if self.sshArgs:
+            command = tuple(shlex.quote(arg) for arg in command)
+
+        proc = await create_subprocess_exec(*self.sshArgs, *command, stdout=PIPE, stderr=PIPE)
         stdout, stderr = await proc.communicate()
 
-        if stderr:
-            raise ValueError('Command exited with errors: {}'.format(stderr))
+        # Some commands write informational output to stderr even on success.
+        if proc.returncode:
+            raise ValueError('Command exited with status {}: {}'.format(proc.returncode, stderr))
 
-        if stdout:
-            stdout = re.split(newlines, stdout.decode())
+        return [line.decode() for line in stdout.splitlines() if line]
 
-            # For some reason, `shell=True` likes to yield an empty string.
-            if stdout[-1] == '':
-                stdout = stdout[:-1]
+    async def _runScript(self, script: str) -> str:
+        """
+        Run a shell script (on the remote host, if there is one) in a single
+        process, fed to bash over stdin.
 
-        return stdout
+        Args:
+            script: The script to run.
+
+        Returns:
+            The script's stdout.
+
+        Raises:
+            ValueError: If the script exits with a non-zero status.
+        """
+        proc = await create_subprocess_exec(*self.sshArgs, 'bash', '-s', stdin=PIPE,
+                                            stdout=PIPE, stderr=PIPE)
+        stdout, stderr = await proc.communicate(script.encode())
+
+        if proc.returncode:
+            raise ValueError('Script exited with errors: {}'.format(stderr))
+
+        return stdout.decode()
 
     async def clone(self) -> Optional[str]:
         """
         Asynchronously clone a dataset by making a call to shell (possibly even to
-        a remote host).
+        a remote host). The clone is marked as pending until `markCreated` is
+        called, and a pending clone of this MI (i.e. a creation that's being
+        retried) is reused. Any other existing dataset fails the clone, so another
+        VM's disks are never reused.
+
+        Returns:
+            Nothing if successful, a string with the error message otherwise.
+        """
+        snapshot = shlex.quote(self.machineImage)
+        dataset = shlex.quote(self.datasetName)
+        script = f"""if [ "$(zfs get -Ho value origin {dataset} 2>/dev/null)" = {snapshot} ] \\
+        && [ "$(zfs get -Ho value {_STATE_PROPERTY} {dataset})" = pending ]; then
+    exit 0
+fi
+zfs clone -o {_STATE_PROPERTY}=pending {snapshot} {dataset}
+"""
+        try:
+            await self._runScript(script)
+        except ValueError as err:
+            return f'Error {err}'
+
+    async def markCreated(self) -> Optional[str]:
+        """
+        Mark the cloned dataset as belonging to a fully created VM, so that it's
+        no longer reused by `clone`.
 
         Returns:
             Nothing if successful, a string with the error message otherwise.
         """
         try:
-            await self._getIO(self.hostString + f'zfs clone {self.machineImage} {self.datasetName}')
+            await self._getIO('zfs', 'set', f'{_STATE_PROPERTY}=created', self.datasetName)
         except ValueError as err:
             return f'Error {err}'
 
@@ -74,33 +123,32 @@ class DatasetManager:
         Returns:
             An optional string, if there was an error during injection.
         """
-        loop = []
+        address = shlex.quote(f'    address {ip}')
+
+        # Loop up the `root.raw` disk image, inject our properties and clean up in
+        # one go, rather than a command (and SSH session) per step. The trap makes
+        # sure the loop's taken down even if a step fails, and only unmounts the
+        # mount point if this script mounted it (not e.g. another injection's).
+        # The address is only appended once, so a retried creation (see `clone`)
+        # can inject again. The loop device skips the page cache where it can, since ZFS
+        # already caches the image in the ARC (it's optional, as older losetups
+        # lack the flag and not every backing file supports it).
+        script = f"""set -e
+LP={shlex.quote(env['REMOTE_LOOP_MOUNTPOINT'])}
+MP=$(zfs list -H -o mountpoint -t filesystem {shlex.quote(self.datasetName)})
+LOOP=$(losetup -fP --show "$MP/root.raw")
+MOUNTED=
+trap 'if [ -n "$MOUNTED" ]; then umount "$LP" || true; fi; losetup -d "$LOOP"' EXIT
+losetup --direct-io=on "$LOOP" 2>/dev/null || true
+mount "${{LOOP}}p1" "$LP"
+MOUNTED=1
+grep -qxF {address} "$LP/etc/network/interfaces" || echo {address} >> "$LP/etc/network/interfaces"
+echo {shlex.quote(hostname)} > "$LP/etc/hostname"
+"""
         try:
-            mountPoint = await self.getMountPoint()
-
-            # Loop up the `root.raw` disk image and inject our properties.
-            loop = await self._getIO(self.hostString + f'losetup -fvP --show {mountPoint}/root.raw')
-            await self._getIO(self.hostString + f'mount {loop[0]}p1 {env["REMOTE_LOOP_MOUNTPOINT"]}')
-
-            # Now inject data into the disk image.
-            await self._getIO(self.hostString + f'\'echo "    address {ip}" >> {env["REMOTE_LOOP_MOUNTPOINT"]}/etc/network/interfaces\'')
-            await self._getIO(self.hostString + f'\'echo {hostname} > {env["REMOTE_LOOP_MOUNTPOINT"]}/etc/hostname\'')
+            await self._runScript(script)
         except ValueError as err:
             return f'Error {err}'
-        finally:
-            # We need to ensure that mount point is cleared and loop's taken down. The
-            # only reason this may not happen is if it's a busy dataset / loop AFAIK.
-            # E.g.:
-            #     umount: / VMPool / test - DELETE: target is busy
-            #     (In some cases useful info about processes that
-            #     use the device is found by lsof(8) or fuser(1).)
-            #     cannot unmount '/VMPool/test-DELETE': umount failed
-            try:
-                await self._getIO(self.hostString + f'umount {env["REMOTE_LOOP_MOUNTPOINT"]}')
-                await self._getIO(self.hostString + f'losetup -d {loop[0]}')
-            except ValueError:
-                # We don't care if they didn't exist. Still work checking.
-                pass
 
     async def getMountPoint(self) -> str:
         """
@@ -109,12 +157,18 @@ class DatasetManager:
         Returns:
             String containing the path associated with the dataset.
         """
+        if self._mountPoint is not None:
+            return self._mountPoint
+
         try:
-            mp = await self._getIO(self.hostString + f'zfs get mountpoint {self.datasetName} -Ho value')
-            return mp[0]
+            mp = await self._getIO('zfs', 'list', '-H', '-o', 'mountpoint', '-t', 'filesystem',
+                                   self.datasetName)
         except ValueError as err:
             return f'Error {err}'
 
+        self._mountPoint = mp[0]
+        return self._mountPoint
+
 
 if __name__ == '__main__':
     from asyncio import run
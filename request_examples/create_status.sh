@@ -0,0 +1,5 @@
+#! /bin/bash
+# Check on a VM that was queued for creation; pass the job ID returned by
+# create_example_vm.sh as the first argument.
+
+curl -X GET "http://10.8.0.42:5000/api/create/status/$1" | jq
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compiled JSON schemas for the API's request bodies. Each validator raises
+`fastjsonschema.JsonSchemaException` on invalid input, including on any
+fields a request isn't expected to have. Optional fields with a default are
+filled in on the validated body.
+"""
+
+from settings import env
+
+import fastjsonschema
+
+__all__ = ['validateList', 'validateXML', 'validateResources', 'validateCreate']
+
+
+_host = {'type': 'string', 'enum': sorted(env['VALID_HOSTS'])}
+
+_hosts = {
+    'type': 'array',
+    'items': _host,
+    'minItems': 1,
+    # Together with the enum, this bounds the list to the valid hosts.
+    'uniqueItems': True
+}
+
+_name = {'type': 'string', 'minLength': 1}
+
+_ipAddress = {
+    'type': 'string',
+    'anyOf': [{'format': 'ipv4'}, {'format': 'ipv6'}]
+}
+
+
+validateList = fastjsonschema.compile({
+    'type': 'object',
+    'additionalProperties': False,
+    'required': ['hosts'],
+    'properties': {
+        'hosts': _hosts,
+        'status': {'enum': ['active', 'inactive']},
+        'stream': {'type': 'boolean'}
+    }
+})
+
+validateXML = fastjsonschema.compile({
+    'type': 'object',
+    'additionalProperties': False,
+    'required': ['guests'],
+    'properties': {
+        'host': _host,
+        'guests': {'type': 'array', 'items': _name}
+    }
+})
+
+validateResources = fastjsonschema.compile({
+    'type': 'object',
+    'additionalProperties': False,
+    'properties': {
+        'hosts': {**_hosts, 'default': [env['DEFAULT_HOST']]}
+    }
+})
+
+validateCreate = fastjsonschema.compile({
+    'type': 'object',
+    'additionalProperties': False,
+    'required': ['guestName', 'ipAddress', 'datasetName', 'bridge'],
+    'properties': {
+        'host': {**_host, 'default': env['DEFAULT_HOST']},
+        'guestName': _name,
+        'ipAddress': _ipAddress,
+        'datasetName': _name,
+        'sourceSnapshot': {**_name, 'default': env['DEFAULT_SNAPSHOT']},
+        'bridge': _name,
+        'memory': {'type': 'integer', 'minimum': 1, 'default': 1024},
+        'cpus': {'type': 'integer', 'minimum': 1, 'default': 1},
+        'template': {**_name, 'default': 'ubuntu'}
+    }
+})
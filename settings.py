@@ -14,17 +14,24 @@ __all__ = ['env']
 load_dotenv(verbose=True)
 
 env = {
-    'DEFAULT_HOST': socket.gethostname(),
-    'VALID_HOSTS': os.getenv('VALID_HOSTS').split(';'),
-    'UPTIME_CACHE_TTL': float(os.getenv('UPTIME_CACHE_TTL')),
+    'DEFAULT_HOST': os.getenv('DEFAULT_HOST') or socket.gethostname(),
+    'VALID_HOSTS': [host for host in os.getenv('VALID_HOSTS', '').split(';') if host],
+    'UPTIME_CACHE_TTL': float(os.getenv('UPTIME_CACHE_TTL', '300')),
+    'UPTIME_LOCAL_CACHE_TTL': float(os.getenv('UPTIME_LOCAL_CACHE_TTL', '5')),
     'UPTIME_CACHE': os.getenv('UPTIME_CACHE'),
+    'DEFAULT_SNAPSHOT': os.getenv('DEFAULT_SNAPSHOT'),
+    'HOST_CACHE_TTL': float(os.getenv('HOST_CACHE_TTL', '10')),
+    'LIBVIRT_THREADS': int(os.getenv('LIBVIRT_THREADS', '32')),
     'REMOTE_LOOP_MOUNTPOINT': os.getenv('REMOTE_LOOP_MOUNTPOINT'),
     'DEFAULT_POOL_DEFINITION_PATH': os.getenv('DEFAULT_POOL_DEFINITION_PATH'),
     'VM_TEMPLATES_DIR': os.getenv('VM_TEMPLATES_DIR'),
-    'LOG_FILE': os.getenv('LOG_FILE')
+    'LOG_FILE': os.getenv('LOG_FILE'),
+    'REDIS_URL': os.getenv('REDIS_URL'),
+    'CREATE_JOB_TIMEOUT': int(os.getenv('CREATE_JOB_TIMEOUT', '600'))
 }
 
-env['VALID_HOSTS_MAX'] = len(env['VALID_HOSTS'])
-
 if env['DEFAULT_HOST'] not in env['VALID_HOSTS']:
-    env['VALID_HOSTS'].append(env['DEFAULT_HOST'])
\ No newline at end of file
+    env['VALID_HOSTS'].append(env['DEFAULT_HOST'])
+
+# Hosts are only ever tested for membership.
+env['VALID_HOSTS'] = frozenset(env['VALID_HOSTS'])
\ No newline at end of file
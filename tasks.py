@@ -0,0 +1,63 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Long-running jobs that are queued by the API and executed by an RQ worker
+(see `basic_rq_worker_run.sh`), so that they don't tie up the API's workers.
+"""
+
+from asyncio import run
+from rq import get_current_job
+
+import uvloop
+
+from libvirtConnector import LVConn
+
+# uvloop spawns DatasetManager's subprocesses without blocking the loop (the
+# API's Uvicorn workers already run on it).
+uvloop.install()
+
+
+class VMCreationError(Exception):
+    """
+    Raised when a VM couldn't be created, so that RQ marks the job as failed.
+    """
+
+
+def createVM(host: str, dataset: str, snapshot: str, guestName: str, ipAddress: str,
+             bridge: str, memory: int, cpus: int, template: str) -> str:
+    """
+    Create a VM on a host; see `LVConn.createVM` for the steps involved.
+
+    Args:
+        host: Host (including the user, e.g. `root@<host>`) to create the VM on.
+        dataset: ZFS dataset to hold this VM's virtual disks.
+        snapshot: ZFS snapshot (effectively a MI) to clone.
+        guestName: Guest host name to inject into the raw MI.
+        ipAddress: IP address to be assigned to the guest VM.
+        bridge: Name of the bridged interface to use.
+        memory: Amount of memory (in MiB) to assign the VM.
+        cpus: Number of CPUs to assign the guest.
+        template: Name of the VM template in `VM_TEMPLATES_DIR` to use.
+
+    Returns:
+        The XML template of the created VM.
+
+    Raises:
+        VMCreationError: If any step failed. The message is also kept in the
+            job's meta, for `/api/create/status` to report.
+    """
+    with LVConn(f'qemu+ssh://{host}/system') as lv:
+        result = run(lv.createVM(dataset, snapshot, guestName, ipAddress,
+                                 bridge, memory, cpus, template))
+
+    # `LVConn.createVM` reports failures as a message instead of the domain XML.
+    if not result or not result.lstrip().startswith('<domain'):
+        message = result or 'VM creation failed.'
+        job = get_current_job()
+        if job is not None:
+            job.meta['error'] = message
+            job.save_meta()
+        raise VMCreationError(message)
+
+    return result
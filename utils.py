@@ -4,23 +4,51 @@
 General utility functions.
 """
 
-from cachetools import cached, TTLCache
+from typing import Dict
+from jinja2 import Template
 
-from settings import env
+import aiofiles
 
-import asyncio
 
+# Contents of files read through `asyncCachedTimedFileIO`, keyed on file name.
+_FILE_CACHE: Dict[str, str] = dict()
 
-#@cached(cache=TTLCache(maxsize=25, ttl=env['UPTIME_CACHE_TTL']))
-def asyncCachedTimedFileIO(fn: str) -> str:
+# Compiled templates read through `asyncCachedTemplate`, keyed on file name.
+_TEMPLATE_CACHE: Dict[str, Template] = dict()
+
+
+async def asyncCachedTimedFileIO(fn: str) -> str:
     """
-    Cache the default directory-type storage pool definition from disk.
+    Read a file (e.g. the default directory-type storage pool definition) from
+    disk without blocking the event loop, and cache its contents in memory.
 
     Args:
         fn: Name of the file to read.
 
     Returns:
-        The base XML for defining a storage pool as a string.
+        The contents of the file as a string.
+    """
+    if fn in _FILE_CACHE:
+        return _FILE_CACHE[fn]
+
+    async with aiofiles.open(fn, 'r') as fh:
+        data = await fh.read()
+
+    _FILE_CACHE[fn] = data
+    return data
+
+
+async def asyncCachedTemplate(fn: str) -> Template:
+    """
+    Read and compile a template (e.g. a VM template in `VM_TEMPLATES_DIR`) once,
+    so later renders skip parsing it.
+
+    Args:
+        fn: Name of the template file.
+
+    Returns:
+        The compiled template.
     """
-    with open(fn, 'r') as fh:
-        return fh.read()
\ No newline at end of file
+    if fn not in _TEMPLATE_CACHE:
+        _TEMPLATE_CACHE[fn] = Template(await asyncCachedTimedFileIO(fn))
+    return _TEMPLATE_CACHE[fn]
\ No newline at end of file